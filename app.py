@@ -1,5 +1,6 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import matplotlib.pyplot as plt
 import io
 from datetime import datetime
@@ -117,11 +118,19 @@ with opt2:
         options=["(None)"] + original_cols,
         index=0
     )
-disch_date_col = st.selectbox(
-    "Discharge date column (optional)",
-    options=["(None)"] + original_cols,
-    index=0
-)
+opt3, opt4 = st.columns(2)
+with opt3:
+    disch_date_col = st.selectbox(
+        "Discharge date column (optional)",
+        options=["(None)"] + original_cols,
+        index=0
+    )
+with opt4:
+    state_col = st.selectbox(
+        "State column (optional, for peer benchmarking)",
+        options=["(None)"] + original_cols,
+        index=(["(None)"] + original_cols).index("State") if "State" in original_cols else 0
+    )
 
 # =========================
 # PREP WORK
@@ -224,28 +233,12 @@ else:
 # =========================
 # Missingness: BLANK ONLY
 # =========================
-# Do not treat 'Not recorded/Not readable' as missing. Only blanks/NaN are missing.
-NOT_MISSING_VALUES = {
-    "not recorded",
-    "not readable",
-    "not record",
-    "not read",
-    "not_recorded/not_readable",
-    "not recorded/not readable",
-}
-
-def is_blank_only(x) -> bool:
-    if pd.isna(x):
-        return True
-    s = str(x).strip()
-    if s == "":
-        return True
-    if s.lower() in NOT_MISSING_VALUES:
-        return False
-    return False
+def blank_mask(series: pd.Series) -> pd.Series:
+    # Only blanks/NaN are missing. 'Not recorded/Not readable' is NOT treated as missing.
+    return series.isna() | series.astype(str).str.strip().eq("")
 
 def blank_count(series: pd.Series) -> int:
-    return int(series.map(is_blank_only).sum())
+    return int(blank_mask(series).sum())
 
 # =========================
 # DQA SUMMARY (scoped)
@@ -309,8 +302,151 @@ def death_rate(series: pd.Series) -> float:
     s = series.astype(str).str.strip().str.lower()
     return float((s == "dead").mean() * 100)
 
-tab_bw, tab_ga, tab_mort, tab_comp = st.tabs(
-    ["Birth weight", "Gestational age", "Mortality", "Completeness & Validity"]
+# Two-sided normal quantiles used for intervals and funnel control limits
+Z_95 = 1.959964
+Z_998 = 3.090232
+
+def wilson_interval(events, n, z: float = Z_95):
+    # Vectorized Wilson score interval; returns (low, high) as proportions
+    events = np.asarray(events, dtype=float)
+    n = np.asarray(n, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = events / n
+        z2 = z * z
+        denom = 1 + z2 / n
+        centre = (p + z2 / (2 * n)) / denom
+        half = z * np.sqrt(p * (1 - p) / n + z2 / (4 * n * n)) / denom
+    low = np.where(n > 0, np.clip(centre - half, 0.0, 1.0), np.nan)
+    high = np.where(n > 0, np.clip(centre + half, 0.0, 1.0), np.nan)
+    return low, high
+
+# Funnel flags use the normal approximation, which is only reliable when the
+# expected events and non-events are both at least this many
+MIN_EXPECTED = 5
+
+def benchmark_stats(counts: pd.DataFrame, metrics: list) -> dict:
+    # One pass over per-facility counts for all metrics at once (facilities x metrics):
+    # rate, Wilson CI, funnel z-score and outlier flag
+    n = counts["records"].to_numpy(dtype=float)[:, None]
+    x = counts[metrics].to_numpy(dtype=float)
+    p0 = x.sum(axis=0) / n.sum()
+
+    low, high = wilson_interval(x, n)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate = x / n
+        se = np.sqrt(p0 * (1 - p0) / n)
+        z = np.where(se > 0, (rate - p0) / se, 0.0)
+
+    enough = (n * p0 >= MIN_EXPECTED) & (n * (1 - p0) >= MIN_EXPECTED)
+    flag = np.select(
+        [~enough, z > Z_998, z > Z_95, z < -Z_998, z < -Z_95],
+        ["Too few expected events", "High (>99.8% limit)", "High (>95% limit)",
+         "Low (<99.8% limit)", "Low (<95% limit)"],
+        default="Within limits",
+    )
+
+    def frame(values):
+        return pd.DataFrame(values, index=counts.index, columns=metrics)
+
+    return {
+        "records": frame(np.broadcast_to(counts["records"].to_numpy()[:, None], x.shape)),
+        "events": counts[metrics],
+        "Rate (%)": frame(rate * 100),
+        "95% CI low (%)": frame(low * 100),
+        "95% CI high (%)": frame(high * 100),
+        "Peer rate (%)": frame(np.broadcast_to(p0 * 100, x.shape)),
+        "z-score": frame(z),
+        "Flag": frame(flag),
+    }
+
+def benchmark_table(stats: dict, metric: str) -> pd.DataFrame:
+    # All facilities for one metric
+    return pd.DataFrame({name: values[metric] for name, values in stats.items()})
+
+def funnel_figure(bench: pd.DataFrame, metric_label: str, highlight=None):
+    p0 = bench["Peer rate (%)"].iloc[0] / 100
+    n_max = float(bench["records"].max())
+
+    fig = plt.figure()
+    plt.scatter(bench["records"], bench["Rate (%)"], s=14, alpha=0.7, label="Facilities")
+    plt.axhline(p0 * 100, color="black", linewidth=1, label="Peer rate")
+
+    # Limits are only drawn where the normal approximation holds (see MIN_EXPECTED)
+    if 0 < p0 < 1:
+        n_min = np.ceil(MIN_EXPECTED / min(p0, 1 - p0))
+        if n_min <= n_max:
+            grid = np.linspace(n_min, n_max, 200)
+            se = np.sqrt(p0 * (1 - p0) / grid)
+            for z, style, label in [(Z_95, "--", "95% limits"), (Z_998, ":", "99.8% limits")]:
+                plt.plot(grid, np.clip(p0 + z * se, 0, 1) * 100, color="grey", linestyle=style, label=label)
+                plt.plot(grid, np.clip(p0 - z * se, 0, 1) * 100, color="grey", linestyle=style)
+
+    if highlight in bench.index:
+        row = bench.loc[[highlight]]
+        plt.scatter(row["records"], row["Rate (%)"], s=50, color="red", label=str(highlight))
+
+    plt.xlabel("Records (n)")
+    plt.ylabel(f"{metric_label} (%)")
+    plt.legend(fontsize="small")
+    return fig
+
+@st.fragment
+def benchmark_view(fac_counts: pd.DataFrame, fac_state, metric_options: list, default_facility=None):
+    # Runs as a fragment so changing a benchmarking control only reruns this numpy step,
+    # not the whole script (aggregation, facility DQA table, report builds)
+    b1, b2, b3 = st.columns(3)
+    with b1:
+        bench_metric = st.selectbox("Metric", options=metric_options)
+    with b2:
+        if fac_state is not None:
+            states = sorted(fac_state.dropna().unique())
+            peer_state = st.selectbox("Peer group", options=["All states"] + states)
+        else:
+            peer_state = "All states"
+            st.caption("Peer group: all facilities (map a State column to benchmark within a state).")
+    with b3:
+        min_records = st.number_input(
+            "Minimum records per facility", min_value=1, value=2 * MIN_EXPECTED, step=1
+        )
+
+    peer_counts = fac_counts[fac_counts["records"] >= min_records]
+    if peer_state != "All states":
+        peer_counts = peer_counts[fac_state.reindex(peer_counts.index) == peer_state]
+
+    if peer_counts.empty:
+        st.warning("No facilities meet the selected peer group / minimum records.")
+        return
+
+    stats = benchmark_stats(peer_counts, metric_options)
+    bench = benchmark_table(stats, bench_metric)
+    bench_facilities = sorted(bench.index)
+    compare_facility = st.selectbox(
+        "Compare facility against peers",
+        options=bench_facilities,
+        index=bench_facilities.index(default_facility) if default_facility in bench_facilities else 0
+    )
+
+    flagged = bench[bench["Flag"].str.startswith(("High", "Low"))]
+    f1, f2, f3 = st.columns(3)
+    f1.metric("Facilities", f"{len(bench):,}")
+    f2.metric("Peer rate", f"{bench['Peer rate (%)'].iloc[0]:.2f}%")
+    f3.metric("Outside funnel limits", f"{len(flagged):,}")
+
+    funnel_fig = funnel_figure(bench, bench_metric, highlight=compare_facility)
+    st.pyplot(funnel_fig)
+
+    st.markdown(f"### {compare_facility}: all metrics vs peers")
+    compare_df = pd.DataFrame({name: values.loc[compare_facility] for name, values in stats.items()})
+    st.dataframe(compare_df, use_container_width=True)
+
+    st.markdown("### Facilities outside funnel limits")
+    st.dataframe(flagged.sort_values("z-score", ascending=False), use_container_width=True)
+
+    st.markdown(f"### {bench_metric} by facility")
+    st.dataframe(bench.sort_values("Rate (%)", ascending=False), use_container_width=True)
+
+tab_bw, tab_ga, tab_mort, tab_bench, tab_comp = st.tabs(
+    ["Birth weight", "Gestational age", "Mortality", "Facility benchmarking", "Completeness & Validity"]
 )
 
 # ---- Birth weight tab
@@ -378,6 +514,9 @@ with tab_mort:
             deaths=("dead_flag", "sum"),
         )
         mort_by_fac["Death (%)"] = (mort_by_fac["deaths"] / mort_by_fac["records"]) * 100
+        death_low, death_high = wilson_interval(mort_by_fac["deaths"], mort_by_fac["records"])
+        mort_by_fac["95% CI low (%)"] = death_low * 100
+        mort_by_fac["95% CI high (%)"] = death_high * 100
         mort_by_fac = mort_by_fac.sort_values("Death (%)", ascending=False)
 
         st.dataframe(mort_by_fac, use_container_width=True)
@@ -388,6 +527,48 @@ with tab_mort:
         st.markdown("### Bottom 10 lowest mortality facilities")
         st.dataframe(mort_by_fac.tail(10), use_container_width=True)
 
+# ---- Facility benchmarking tab
+with tab_bench:
+    st.markdown("### Facility benchmarking (FINAL filtered dataset)")
+    st.caption(
+        "Rates use all records as denominator. Intervals are 95% Wilson score intervals. "
+        "Facilities outside the funnel limits around the peer rate are flagged. Funnel limits use a "
+        "normal approximation and are not reliable for small n, so facilities with fewer than "
+        f"{MIN_EXPECTED} expected events (or non-events) are not flagged."
+    )
+
+    # Event flags per record; aggregated once per facility below
+    bench_flags = pd.DataFrame(index=work.index)
+    bench_flags["records"] = 1
+    if outcome_col != "(None)":
+        bench_flags["Death"] = work[outcome_col].astype(str).str.strip().str.lower().eq("dead")
+    if cpap_col != "(None)":
+        bench_flags["CPAP yes"] = work[cpap_col].astype(str).str.strip().str.lower().eq("yes")
+    if kmc_col != "(None)":
+        bench_flags["KMC yes"] = work[kmc_col].astype(str).str.strip().str.lower().eq("yes")
+    for col in key_cols[1:]:
+        bench_flags[f"{col} blank missing"] = blank_mask(work[col])
+
+    fac_counts = bench_flags.groupby(work[facility_col]).sum()
+    metric_options = [c for c in fac_counts.columns if c != "records"]
+
+    # Each facility belongs to its most frequent non-blank State; blank States are ignored
+    fac_state = None
+    if state_col != "(None)":
+        st.caption("Facilities are assigned to their most frequently recorded State.")
+        state_pairs = pd.DataFrame({
+            "facility": work[facility_col],
+            "state": work[state_col].astype(str).str.strip().where(~blank_mask(work[state_col])),
+        }).dropna()
+        fac_state = (
+            state_pairs.value_counts()
+            .reset_index()
+            .drop_duplicates("facility")
+            .set_index("facility")["state"]
+        )
+
+    benchmark_view(fac_counts, fac_state, metric_options, default_facility=selected_facility)
+
 # ---- Completeness tab
 with tab_comp:
     st.markdown("### Blank-only completeness (selected important fields)")